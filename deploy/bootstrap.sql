@@ -127,8 +127,11 @@ create index if not exists idx_members_zone        on public.project_members usi
 -- B-tree
 create index if not exists idx_features_layer_id   on public.features(layer_id);
 create index if not exists idx_features_status      on public.features(status);
+create index if not exists idx_features_layer_status on public.features(layer_id, status);
 create index if not exists idx_corrections_feat     on public.corrections(feature_id);
 create index if not exists idx_corrections_layer    on public.corrections(layer_id);
+create unique index if not exists idx_corrections_kobo_submission
+  on public.corrections(kobo_submission_id) where kobo_submission_id is not null;
 create index if not exists idx_layers_project       on public.layers(project_id);
 create index if not exists idx_members_project      on public.project_members(project_id);
 create index if not exists idx_members_user         on public.project_members(user_id);
@@ -215,6 +218,44 @@ create trigger on_auth_user_created
 after insert on auth.users
 for each row execute function public.handle_new_user();
 
+-- Tell the export service to drop its cached layer lookups
+create or replace function public.notify_layers_changed()
+returns trigger language plpgsql as $$
+begin
+  perform pg_notify('layers_changed', '');
+  return null;
+end;
+$$;
+
+drop trigger if exists trg_layers_notify on public.layers;
+create trigger trg_layers_notify
+after insert or update or delete on public.layers
+for each statement execute function public.notify_layers_changed();
+
+drop trigger if exists trg_projects_notify on public.projects;
+create trigger trg_projects_notify
+after update or delete on public.projects
+for each statement execute function public.notify_layers_changed();
+
+-- ... and its cached feature counts and property keys
+create or replace function public.notify_features_changed()
+returns trigger language plpgsql as $$
+begin
+  perform pg_notify('features_changed', '');
+  return null;
+end;
+$$;
+
+drop trigger if exists trg_features_notify on public.features;
+create trigger trg_features_notify
+after insert or delete or update of status, props on public.features
+for each statement execute function public.notify_features_changed();
+
+drop trigger if exists trg_corrections_notify on public.corrections;
+create trigger trg_corrections_notify
+after insert or delete or update of props_patch on public.corrections
+for each statement execute function public.notify_features_changed();
+
 -- =====================================================
 -- 6. RPCs
 -- =====================================================
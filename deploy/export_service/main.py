@@ -9,24 +9,39 @@ Meant to sit behind Kong or Caddy for auth verification.
 
 import io
 import csv
-import json
+import hashlib
+import itertools
 import os
+import queue
+import select
+import shutil
+import struct
 import tempfile
+import threading
+import time
 import uuid
-from contextlib import asynccontextmanager
+import weakref
+import zipfile
+import zlib
+from contextlib import asynccontextmanager, closing, contextmanager
 from datetime import datetime
 from enum import Enum
 from typing import Optional
 
+import anyio
 import fiona
+import numpy as np
 import orjson
 import psycopg2
 import psycopg2.extras
-from fastapi import FastAPI, HTTPException, Query, Response
+import psycopg2.pool
+import pyogrio.raw
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from shapely import wkb
-from shapely.geometry import Point, mapping as geom_mapping
+from starlette.background import BackgroundTask
 
 
 # ── Config ──────────────────────────────────────────
@@ -38,19 +53,121 @@ DATABASE_URL = os.getenv(
 
 ALLOWED_ORIGINS = os.getenv("CORS_ORIGINS", "*").split(",")
 
+# Rows fetched per round trip by the export cursors
+EXPORT_ITERSIZE = int(os.getenv("EXPORT_ITERSIZE", "2000"))
+
+# Bytes buffered before a streamed COPY chunk is sent
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# zlib level for gzip-encoded streaming exports
+GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "4"))
+
+# Leading rows inspected to type the Fiona schema
+SCHEMA_SAMPLE_SIZE = 50
+
+# Writer for GPKG/SHP/KML: "pyogrio" (bulk, default) or "fiona"
+EXPORT_ENGINE = os.getenv("EXPORT_ENGINE", "pyogrio")
+
+# Drivers whose append only adds to the file; the others (KML) rewrite it
+# on every append, so they are written through one open Fiona dataset
+APPEND_DRIVERS = {"GPKG", "ESRI Shapefile"}
+
+# GDAL's KML driver writes fine but Fiona leaves it disabled by default
+fiona.supported_drivers["KML"] = "rw"
+
+# Seconds a cached layer lookup stays valid
+LOOKUP_CACHE_TTL = float(os.getenv("LOOKUP_CACHE_TTL", "60"))
+
+# Seconds cached feature counts (layer list, export meta) stay valid
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "30"))
+
+# Connection pool bounds, per uvicorn worker
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "4"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+
+# Seconds a request waits for a free connection before getting a 503
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Connections streaming exports may not take, so that /meta, /layers and
+# the webhook are still served while downloads hold the rest
+DB_POOL_RESERVED = int(os.getenv("DB_POOL_RESERVED", "4"))
+
+# Seconds a pooled connection's statement may run (0 disables); GeoJSON
+# COPY exports, which last as long as the download, are exempt
+DB_STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", "60"))
+
+
+def _cast_bytea(value: Optional[str], cur) -> Optional[bytes]:
+    """bytea -> bytes, decoded straight from PostgreSQL's hex output."""
+    if value is None:
+        return None
+    if value.startswith("\\x"):
+        return bytes.fromhex(value[2:])
+    return bytes(psycopg2.BINARY(value, cur))  # bytea_output = 'escape'
+
+
+# Return WKB as bytes (which GDAL accepts as is) instead of a memoryview
+psycopg2.extensions.register_type(
+    psycopg2.extensions.new_type(psycopg2.BINARY.values, "BYTEA_BYTES", _cast_bytea)
+)
+
 
 # ── App lifecycle ───────────────────────────────────
 
-def get_conn():
-    return psycopg2.connect(DATABASE_URL)
+@contextmanager
+def get_conn(streaming: bool = False):
+    """Borrow a connection from the pool; it is returned (and rolled back
+    if left mid-transaction) on exit. When every connection is in use the
+    caller waits up to DB_POOL_TIMEOUT for one, then gets a 503. Streaming
+    exports also take one of the DB_POOL_MAX - DB_POOL_RESERVED stream
+    slots, leaving the reserved connections to the short queries."""
+    pool = app.state.pool
+    slots = [app.state.stream_slots, app.state.pool_slots] if streaming else [app.state.pool_slots]
+    deadline = time.monotonic() + DB_POOL_TIMEOUT
+    acquired = []
+    try:
+        for slot in slots:
+            if not slot.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                raise HTTPException(
+                    status_code=503,
+                    detail="All database connections are busy, retry shortly.",
+                    headers={"Retry-After": "5"},
+                )
+            acquired.append(slot)
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+    finally:
+        for slot in reversed(acquired):
+            slot.release()
 
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):
-    # Startup: verify DB connection
-    conn = get_conn()
-    conn.close()
+    # Startup: open the pool (fails fast if the DB is unreachable)
+    application.state.pool = psycopg2.pool.ThreadedConnectionPool(
+        minconn=DB_POOL_MIN,
+        maxconn=DB_POOL_MAX,
+        dsn=DATABASE_URL,
+        options=f"-c statement_timeout={int(DB_STATEMENT_TIMEOUT * 1000)}",
+    )
+    application.state.pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+    application.state.stream_slots = threading.BoundedSemaphore(
+        max(1, DB_POOL_MAX - DB_POOL_RESERVED)
+    )
+
+    stop_listener = threading.Event()
+    threading.Thread(
+        target=_listen_for_layer_changes,
+        args=(stop_listener,),
+        name="layers-listener",
+        daemon=True,
+    ).start()
     yield
+    stop_listener.set()
+    application.state.pool.closeall()
 
 
 app = FastAPI(
@@ -99,128 +216,796 @@ class ExportMeta(BaseModel):
 # ── Helpers ─────────────────────────────────────────
 
 
-def _fetch_layer_features(
+class _TTLCache:
+    """Small thread-safe cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.maxsize and key not in self._data:
+                # Evict the oldest entry
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# kobo_form_id -> (layer_id, fields)
+_kobo_layer_cache = _TTLCache(ttl=LOOKUP_CACHE_TTL)
+
+# (layer_id, project_slug) -> layer row
+_layer_cache = _TTLCache(ttl=LOOKUP_CACHE_TTL)
+
+# layer_id -> schema properties declared by layers.fields
+_declared_schema_cache = _TTLCache(ttl=LOOKUP_CACHE_TTL)
+
+# (layer_id, status, use_corrected) -> export property keys
+_property_keys_cache = _TTLCache(ttl=LOOKUP_CACHE_TTL)
+
+# project_slug -> list_layers response
+_layer_list_cache = _TTLCache(ttl=COUNT_CACHE_TTL, maxsize=512)
+
+# (layer_id, project_slug, status) -> feature count
+_feature_count_cache = _TTLCache(ttl=COUNT_CACHE_TTL, maxsize=512)
+
+
+def _clear_count_caches():
+    _layer_list_cache.clear()
+    _feature_count_cache.clear()
+    _property_keys_cache.clear()
+
+
+def _clear_layer_caches():
+    _kobo_layer_cache.clear()
+    _layer_cache.clear()
+    _declared_schema_cache.clear()
+    _clear_count_caches()
+
+
+def _listen_for_layer_changes(stop: threading.Event):
+    """
+    Clear the cached lookups on `layers_changed` and the cached counts and
+    property keys on `features_changed` notifications (sent by the triggers in
+    layers_notify.sql and features_notify.sql). Runs in a daemon thread
+    for the app's lifetime and reconnects on failure; while it is down,
+    the cache TTLs still bound staleness.
+    """
+    while not stop.is_set():
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+        except psycopg2.Error:
+            stop.wait(5)
+            continue
+        try:
+            conn.autocommit = True
+            conn.cursor().execute("LISTEN layers_changed; LISTEN features_changed")
+            # Changes made while we were not listening went unnoticed
+            _clear_layer_caches()
+            while not stop.is_set():
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                channels = {n.channel for n in conn.notifies}
+                conn.notifies.clear()
+                if "layers_changed" in channels:
+                    _clear_layer_caches()
+                elif channels:
+                    _clear_count_caches()
+        except psycopg2.Error:
+            stop.wait(5)
+        finally:
+            conn.close()
+
+
+# connection -> names of the statements prepared on it
+_prepared_statements: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def _execute_prepared(cur, name: str, sql: str, params: tuple):
+    """
+    Execute `sql` (with $1..$n placeholders) as a server-side prepared
+    statement, preparing it the first time it runs on this connection so
+    later calls skip parse and plan.
+    """
+    with _prepared_lock:
+        prepared = _prepared_statements.setdefault(cur.connection, set())
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+# Latest correction per feature (aliased `c`)
+_LATEST_CORRECTION_JOIN = """
+    LEFT JOIN LATERAL (
+        SELECT props_patch, geom_corrected
+        FROM public.corrections
+        WHERE feature_id = f.id
+        ORDER BY created_at DESC
+        LIMIT 1
+    ) c ON TRUE
+"""
+
+# Metadata fields merged into every feature's properties
+_META_KEYS = ("_id", "_status", "_source_file", "_corrected_at", "_validated_at")
+
+_META_PROPS = """
+    jsonb_build_object(
+        '_id', f.id::text,
+        '_status', f.status,
+        '_source_file', f.source_file,
+        '_corrected_at', f.corrected_at,
+        '_validated_at', f.validated_at
+    )
+"""
+
+# Select list of the file exports (GPKG, SHP, KML) for _features_query:
+# WKB, handed to GDAL as is, and props already carrying the metadata.
+# {geom} and {props} resolve to the corrected or raw expressions.
+_WKB_COLUMNS = "ST_AsBinary({geom}) AS geom_wkb, {props} AS props"
+
+# Feature text assembled by concatenation: json_build_object would pad
+# every key with " : " and re-parse the ST_AsGeoJSON output
+_GEOJSON_FEATURE_COLUMN = """
+    '{{"type":"Feature","id":"' || f.id::text
+    || '","geometry":' || COALESCE(ST_AsGeoJSON({geom}), 'null')
+    || ',"properties":' || ({props})::text || '}}'
+"""
+
+
+def _get_layer(cur, layer_id: str, project_slug: str) -> dict:
+    """
+    Fetch layer metadata, raising 404 if it does not belong to the project.
+    Hits are cached until the layers change (or LOOKUP_CACHE_TTL expires).
+    """
+    layer = _layer_cache.get((layer_id, project_slug))
+    if layer is not None:
+        return layer
+
+    _execute_prepared(
+        cur,
+        "export_layer",
+        """
+        SELECT l.id, l.name, l.geometry_type, l.fields
+        FROM public.layers l
+        JOIN public.projects p ON p.id = l.project_id
+        WHERE l.id = $1 AND p.slug = $2
+        """,
+        (layer_id, project_slug),
+    )
+    layer = cur.fetchone()
+    if not layer:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Layer {layer_id} not found in project '{project_slug}'",
+        )
+    _layer_cache.set((layer_id, project_slug), layer)
+    return layer
+
+
+def _features_query(
+    columns: str,
     layer_id: str,
-    project_slug: str,
     status: StatusFilter,
-    use_corrected: bool = True,
+    use_corrected: bool,
 ):
     """
-    Fetch features for a given layer within a project.
+    Build the feature SELECT for one layer.
     If use_corrected, merges the latest correction patch into props
     and uses corrected geometry when available.
     """
-    conn = get_conn()
-    try:
+    if use_corrected:
+        geom = "COALESCE(c.geom_corrected, f.geom)"
+        props = "f.props || COALESCE(c.props_patch, '{}'::jsonb)"
+        join = _LATEST_CORRECTION_JOIN
+    else:
+        geom = "f.geom"
+        props = "f.props"
+        join = ""
+    props += " || " + _META_PROPS
+
+    query = f"""
+        SELECT {columns.format(geom=geom, props=props)}
+        FROM public.features f
+        {join}
+        WHERE f.layer_id = %s
+    """
+    params: list = [layer_id]
+
+    if status != StatusFilter.all:
+        query += " AND f.status = %s"
+        params.append(status.value)
+
+    query += " ORDER BY f.created_at"
+    return query, params
+
+
+def _stream_rows(layer_id: str, project_slug: str, query: str, params: list, cursor_factory=None):
+    """
+    Yield the layer, then every row of `query`, read through a server-side
+    cursor EXPORT_ITERSIZE rows at a time. The pooled connection stays
+    borrowed until the generator is exhausted or closed.
+    """
+    with get_conn(streaming=True) as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        yield _get_layer(cur, layer_id, project_slug)
 
-        # Verify layer belongs to project
-        cur.execute(
-            """
-            SELECT l.id, l.name, l.geometry_type, l.fields
-            FROM public.layers l
-            JOIN public.projects p ON p.id = l.project_id
-            WHERE l.id = %s AND p.slug = %s
-            """,
-            (layer_id, project_slug),
+        with conn.cursor(
+            name=f"export_{uuid.uuid4().hex}", cursor_factory=cursor_factory
+        ) as named:
+            named.itersize = EXPORT_ITERSIZE
+            named.execute(query, params)
+            yield from named
+
+
+def _resume(first, stream):
+    """`stream` with `first`, already read from it, put back in front;
+    unlike a chain, closing it closes `stream`."""
+    yield first
+    yield from stream
+
+
+def _fetch_layer_features(
+    layer_id: str,
+    project_slug: str,
+    columns: str,
+    status: StatusFilter,
+    use_corrected: bool = True,
+    cursor_factory=None,
+):
+    """
+    Open a feature stream for a layer within a project.
+    Returns (layer, rows) where rows is a lazy iterator; both 404 cases are
+    raised here, before any response byte is sent.
+    """
+    query, params = _features_query(columns, layer_id, status, use_corrected)
+    stream = _stream_rows(layer_id, project_slug, query, params, cursor_factory)
+    layer = next(stream)
+
+    first = next(stream, None)
+    if first is None:
+        raise HTTPException(
+            status_code=404,
+            detail="No features found matching the criteria.",
         )
-        layer = cur.fetchone()
-        if not layer:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Layer {layer_id} not found in project '{project_slug}'",
-            )
 
-        # Build query — optionally join latest correction
-        if use_corrected:
-            query = """
-                SELECT
-                    f.id,
-                    f.status,
-                    f.props || COALESCE(c.props_patch, '{}'::jsonb) AS props,
-                    ST_AsBinary(COALESCE(c.geom_corrected, f.geom)) AS geom_wkb,
-                    f.source_file,
-                    f.corrected_by,
-                    f.corrected_at,
-                    f.validated_by,
-                    f.validated_at,
-                    f.created_at,
-                    f.updated_at
-                FROM public.features f
-                LEFT JOIN LATERAL (
-                    SELECT props_patch, geom_corrected
-                    FROM public.corrections
-                    WHERE feature_id = f.id
-                    ORDER BY created_at DESC
-                    LIMIT 1
-                ) c ON TRUE
-                WHERE f.layer_id = %s
-            """
-        else:
-            query = """
-                SELECT
-                    f.id,
-                    f.status,
-                    f.props,
-                    ST_AsBinary(f.geom) AS geom_wkb,
-                    f.source_file,
-                    f.corrected_by,
-                    f.corrected_at,
-                    f.validated_by,
-                    f.validated_at,
-                    f.created_at,
-                    f.updated_at
-                FROM public.features f
-                WHERE f.layer_id = %s
-            """
+    return layer, _resume(first, stream)
 
-        params: list = [layer_id]
 
+class _CopyAborted(Exception):
+    """Raised inside a COPY whose consumer has gone away."""
+
+
+class _CopyQueueWriter:
+    """
+    File-like sink for copy_expert: buffers COPY output into chunks of
+    whole lines and hands them to a bounded queue, so the COPY runs at
+    most a few chunks ahead of the consumer.
+    """
+
+    def __init__(self, out: queue.Queue, stop: threading.Event):
+        self.out = out
+        self.stop = stop
+        self.buf: list = []
+        self.size = 0
+
+    def put(self, item):
+        # A put blocked on a full queue is woken by the consumer draining
+        # it after setting `stop`; the next one then aborts here
+        if self.stop.is_set():
+            raise _CopyAborted()
+        self.out.put(item)
+
+    def write(self, data: bytes):
+        # One call per row; rows never straddle chunks
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= STREAM_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.put(b"".join(self.buf))
+            self.buf, self.size = [], 0
+
+
+def _stream_copy(layer_id: str, project_slug: str, build, unescape: bool):
+    """
+    Yield the layer, then the output of the COPY ... TO STDOUT statement
+    returned by `build(cur, layer)` (with a header to put before the first
+    line) as chunks of whole lines, read by a helper thread. The pooled
+    connection stays borrowed until the generator is exhausted or closed;
+    closing it early cancels the COPY.
+    """
+    with get_conn(streaming=True) as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        layer = _get_layer(cur, layer_id, project_slug)
+        yield layer
+
+        sql, header = build(cur, layer)
+        # Lifted in the same round trip as the COPY (libpq stops at its
+        # result); it lasts as long as the client takes to download
+        sql = b"SET LOCAL statement_timeout = 0; " + sql
+        chunks: queue.Queue = queue.Queue(maxsize=4)
+        stop = threading.Event()
+        writer = _CopyQueueWriter(chunks, stop)
+        done = object()
+
+        def produce():
+            try:
+                conn.cursor().copy_expert(sql, writer)
+                writer.flush()
+                writer.put(done)
+            except _CopyAborted:
+                pass
+            except BaseException as exc:  # re-raised by the consumer
+                try:
+                    writer.put(exc)
+                except _CopyAborted:
+                    pass
+
+        producer = threading.Thread(target=produce, name="export-copy", daemon=True)
+        producer.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    break
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                if unescape:
+                    # COPY's text format doubles backslashes; JSON text has
+                    # no other character it escapes (tabs, newlines are \t, \n)
+                    chunk = chunk.replace(b"\\\\", b"\\")
+                yield header + chunk
+                header = b""
+        finally:
+            if producer.is_alive():
+                stop.set()
+                conn.cancel()
+                while True:
+                    try:
+                        chunks.get_nowait()
+                    except queue.Empty:
+                        break
+                producer.join()
+
+
+def _copy_column(column: str, layer_id: str, status: StatusFilter, use_corrected: bool):
+    """COPY builder for one text column, one value per line (text format)."""
+    query, params = _features_query(column, layer_id, status, use_corrected)
+
+    def build(cur, layer):
+        return b"COPY (" + cur.mogrify(query, params) + b") TO STDOUT", b""
+
+    return build
+
+
+def _layer_property_keys(
+    cur,
+    layer_id: str,
+    layer: dict,
+    status: StatusFilter,
+    use_corrected: bool,
+) -> list:
+    """
+    Property columns of a layer's CSV and file exports: its declared
+    fields, then every other key found in the exported features (and
+    their correction patches, if merged), then the metadata. Cached until
+    the features change (or LOOKUP_CACHE_TTL expires).
+    """
+    cache_key = (layer_id, status, use_corrected)
+    keys = _property_keys_cache.get(cache_key)
+    if keys is not None:
+        return keys
+
+    query = "SELECT jsonb_object_keys(f.props) AS key FROM public.features f WHERE f.layer_id = %s"
+    params: list = [layer_id]
+    if status != StatusFilter.all:
+        query += " AND f.status = %s"
+        params.append(status.value)
+    if use_corrected:
+        query += (
+            " UNION SELECT jsonb_object_keys(c.props_patch)"
+            " FROM public.corrections c"
+            " JOIN public.features f ON f.id = c.feature_id"
+            " WHERE c.layer_id = %s"
+        )
+        params.append(layer_id)
         if status != StatusFilter.all:
             query += " AND f.status = %s"
             params.append(status.value)
+    cur.execute(query, params)
+    found = {row["key"] for row in cur.fetchall()}
 
-        query += " ORDER BY f.created_at"
+    declared = [k for k in _declared_properties(layer) if k not in _META_KEYS]
+    keys = [*declared, *sorted(found.difference(declared, _META_KEYS)), *_META_KEYS]
+    _property_keys_cache.set(cache_key, keys)
+    return keys
 
-        cur.execute(query, params)
-        rows = cur.fetchall()
 
-        return layer, rows
-    finally:
-        conn.close()
+def _copy_csv(layer_id: str, status: StatusFilter, use_corrected: bool):
+    """
+    COPY builder for the CSV export: WKT, then one column per property
+    (see _layer_property_keys).
+    """
+    def build(cur, layer):
+        keys = _layer_property_keys(cur, layer_id, layer, status, use_corrected)
+        query, params = _features_query("{geom} AS g, {props} AS p", layer_id, status, use_corrected)
+        columns = ", ".join(["ST_AsText(g)"] + ["p->>%s"] * len(keys))
+        sql = f"COPY (SELECT {columns} FROM ({query}) s) TO STDOUT WITH (FORMAT csv)"
 
+        header = io.StringIO()
+        csv.writer(header, lineterminator="\n").writerow(["_wkt", *keys])
+        return cur.mogrify(sql, [*keys, *params]), header.getvalue().encode()
 
-def _rows_to_geojson(layer: dict, rows: list) -> dict:
-    """Convert DB rows to a GeoJSON FeatureCollection dict."""
-    features = []
-    for row in rows:
-        geom = wkb.loads(bytes(row["geom_wkb"]))
-        props = dict(row["props"]) if row["props"] else {}
-        # Add metadata fields
-        props["_id"] = str(row["id"])
-        props["_status"] = row["status"]
-        props["_source_file"] = row.get("source_file")
-        props["_corrected_at"] = (
-            row["corrected_at"].isoformat() if row.get("corrected_at") else None
-        )
-        props["_validated_at"] = (
-            row["validated_at"].isoformat() if row.get("validated_at") else None
+    return build
+
+
+def _copy_layer_features(layer_id: str, project_slug: str, build, unescape: bool = False):
+    """
+    Like _fetch_layer_features, for output streamed through COPY (see
+    _stream_copy). Returns (layer, chunks) of whole lines.
+    """
+    stream = _stream_copy(layer_id, project_slug, build, unescape)
+    layer = next(stream)
+
+    first = next(stream, None)
+    if first is None:
+        raise HTTPException(
+            status_code=404,
+            detail="No features found matching the criteria.",
         )
 
-        features.append(
-            {
-                "type": "Feature",
-                "id": str(row["id"]),
-                "geometry": geom_mapping(geom),
-                "properties": props,
-            }
+    return layer, _resume(first, stream)
+
+
+def _count_layer_features(layer_id: str, project_slug: str, status: StatusFilter) -> int:
+    """Count a layer's features without transferring them (cached)."""
+    key = (layer_id, project_slug, status)
+    count = _feature_count_cache.get(key)
+    if count is not None:
+        return count
+
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        _get_layer(cur, layer_id, project_slug)
+
+        query = "SELECT count(*) AS feature_count FROM public.features f WHERE f.layer_id = $1"
+        if status == StatusFilter.all:
+            _execute_prepared(cur, "export_count", query, (layer_id,))
+        else:
+            query += " AND f.status = $2"
+            _execute_prepared(cur, "export_count_status", query, (layer_id, status.value))
+
+        count = cur.fetchone()["feature_count"]
+
+    _feature_count_cache.set(key, count)
+    return count
+
+
+_WKB_TYPES = {
+    1: "Point",
+    2: "LineString",
+    3: "Polygon",
+    4: "MultiPoint",
+    5: "MultiLineString",
+    6: "MultiPolygon",
+    7: "GeometryCollection",
+}
+
+
+def _read_wkb(buf, offset: int):
+    """
+    Decode one (ISO or extended) WKB geometry at `offset` into a GeoJSON
+    geometry dict. Returns (geometry, offset just past it). M values are
+    dropped, as GeoJSON has no room for them.
+    """
+    order = "<" if buf[offset] == 1 else ">"
+    (code,) = struct.unpack_from(order + "I", buf, offset + 1)
+    offset += 5
+
+    has_z = bool(code & 0x80000000)
+    has_m = bool(code & 0x40000000)
+    if code & 0x20000000:  # EWKB SRID, skipped
+        offset += 4
+    code &= 0x0FFFFFFF
+    iso_dims, code = divmod(code, 1000)
+    has_z = has_z or iso_dims in (1, 3)
+    has_m = has_m or iso_dims in (2, 3)
+
+    dims = 2 + has_z + has_m
+    keep = 3 if has_z else 2
+    dtype = order + "f8"
+    count_fmt = order + "I"
+
+    def coords(offset):
+        (n,) = struct.unpack_from(count_fmt, buf, offset)
+        offset += 4
+        arr = np.frombuffer(buf, dtype=dtype, count=n * dims, offset=offset)
+        arr = arr.reshape(n, dims)
+        if keep != dims:
+            arr = arr[:, :keep]
+        return arr.tolist(), offset + 8 * n * dims
+
+    def rings(offset):
+        (n,) = struct.unpack_from(count_fmt, buf, offset)
+        offset += 4
+        out = []
+        for _ in range(n):
+            ring, offset = coords(offset)
+            out.append(ring)
+        return out, offset
+
+    geom_type = _WKB_TYPES[code]
+
+    if code == 1:
+        point = np.frombuffer(buf, dtype=dtype, count=dims, offset=offset)
+        offset += 8 * dims
+        # Empty points are encoded as NaN coordinates
+        value = [] if np.isnan(point[0]) else point[:keep].tolist()
+    elif code == 2:
+        value, offset = coords(offset)
+    elif code == 3:
+        value, offset = rings(offset)
+    else:
+        (n,) = struct.unpack_from(count_fmt, buf, offset)
+        offset += 4
+        parts = []
+        for _ in range(n):
+            part, offset = _read_wkb(buf, offset)
+            parts.append(part)
+        if code == 7:
+            return {"type": geom_type, "geometries": parts}, offset
+        value = [part["coordinates"] for part in parts]
+
+    return {"type": geom_type, "coordinates": value}, offset
+
+
+def _wkb_to_geojson(buf) -> dict:
+    """Decode a WKB buffer (bytes or memoryview) to a GeoJSON geometry dict."""
+    return _read_wkb(buf, 0)[0]
+
+
+# Specialized decoders: every feature of a layer shares its geometry
+# type, so the layout can be fixed once per export. They handle the
+# little-endian ISO WKB that PostGIS emits and hand anything else to
+# _wkb_to_geojson.
+
+_LE_UINT32 = struct.Struct("<I")
+
+
+def _le_point_reader(dims: int):
+    fmt = struct.Struct(f"<{dims}d")
+
+    def read(buf, offset):
+        point = list(fmt.unpack_from(buf, offset))
+        # Empty points are encoded as NaN coordinates
+        return ([] if point[0] != point[0] else point), offset + 8 * dims
+
+    return read
+
+
+def _le_coords_reader(dims: int):
+    def read(buf, offset):
+        (n,) = _LE_UINT32.unpack_from(buf, offset)
+        offset += 4
+        arr = np.frombuffer(buf, dtype="<f8", count=n * dims, offset=offset)
+        return arr.reshape(n, dims).tolist(), offset + 8 * n * dims
+
+    return read
+
+
+def _le_parts_reader(read, headers: bool):
+    """Read a count followed by that many `read` items; multi-geometry
+    parts carry their own 5-byte WKB header, polygon rings do not."""
+    def read_parts(buf, offset):
+        (n,) = _LE_UINT32.unpack_from(buf, offset)
+        offset += 4
+        parts = []
+        for _ in range(n):
+            if headers:
+                offset += 5
+            part, offset = read(buf, offset)
+            parts.append(part)
+        return parts, offset
+
+    return read_parts
+
+
+def _le_decoder(code: int, geom_type: str, read):
+    header = struct.pack("<BI", 1, code)
+
+    def decode(buf) -> dict:
+        if buf[:5] == header:
+            return {"type": geom_type, "coordinates": read(buf, 5)[0]}
+        return _wkb_to_geojson(buf)
+
+    return decode
+
+
+def _build_wkb_decoders() -> dict:
+    decoders = {}
+    for dims, suffix, base in ((2, "", 0), (3, "Z", 1000)):
+        point = _le_point_reader(dims)
+        line = _le_coords_reader(dims)
+        polygon = _le_parts_reader(line, headers=False)
+        readers = {
+            1: point,
+            2: line,
+            3: polygon,
+            4: _le_parts_reader(point, headers=True),
+            5: _le_parts_reader(line, headers=True),
+            6: _le_parts_reader(polygon, headers=True),
+        }
+        for code, read in readers.items():
+            geom_type = _WKB_TYPES[code]
+            decoders[geom_type + suffix] = _le_decoder(base + code, geom_type, read)
+    return decoders
+
+
+# layer geometry_type -> WKB decoder
+_WKB_DECODERS = _build_wkb_decoders()
+
+
+def _wkb_decoder(geometry_type: str):
+    """Pick the WKB decoder for a layer's geometry type."""
+    return _WKB_DECODERS.get(geometry_type, _wkb_to_geojson)
+
+
+def _fiona_records(rows, layer: dict, schema: dict):
+    """Lazily turn DB rows into Fiona records restricted to the schema keys."""
+    decode = _wkb_decoder(layer.get("geometry_type", "Geometry"))
+    serialize = _compile_serializer(schema)
+    for row in rows:
+        yield {
+            "geometry": decode(row["geom_wkb"]),
+            "properties": serialize(row["props"]),
+        }
+
+
+def _ogr_column(values: list, kind: str):
+    """Build a pyogrio field array, plus its null mask, for one schema column."""
+    if kind == "str":
+        data = [v if v is None or isinstance(v, str) else str(v) for v in values]
+        return np.array(data, dtype=object), None
+
+    dtype = {"int": np.int64, "float": np.float64, "bool": np.bool_}[kind]
+    mask = np.array([v is None for v in values], dtype=bool)
+    data = np.array([0 if v is None else v for v in values], dtype=dtype)
+    return data, mask if mask.any() else None
+
+
+def _write_pyogrio(path: str, driver: str, layer: dict, schema: dict, rows):
+    """
+    Write rows with pyogrio: WKB goes to GDAL untouched and each batch of
+    EXPORT_ITERSIZE rows is a single OGR call, appended to the file. Only
+    for APPEND_DRIVERS, where an append does not rewrite what is there.
+    """
+    keys = list(schema["properties"])
+    kinds = list(schema["properties"].values())
+    serialize = _compile_serializer(schema)
+    geometry_type = _geometry_type_to_ogr(layer.get("geometry_type", "Geometry"))
+
+    append = False
+    for batch in iter(lambda: list(itertools.islice(rows, EXPORT_ITERSIZE)), []):
+        geometry = np.array([row["geom_wkb"] for row in batch], dtype=object)
+        records = [serialize(row["props"]) for row in batch]
+
+        field_data, field_mask = [], []
+        for key, kind in zip(keys, kinds):
+            data, mask = _ogr_column([r[key] for r in records], kind)
+            field_data.append(data)
+            field_mask.append(mask)
+
+        pyogrio.raw.write(
+            path,
+            geometry,
+            field_data,
+            keys,
+            field_mask=field_mask,
+            driver=driver,
+            geometry_type=geometry_type,
+            crs="EPSG:4326",
+            append=append,
         )
+        append = True
 
-    return {
-        "type": "FeatureCollection",
-        "name": layer["name"],
-        "features": features,
-    }
+
+def _geojson_chunks(layer: dict, chunks, pretty: bool = False):
+    """
+    Wrap server-rendered Feature lines (chunks of COPY output) in a
+    FeatureCollection. Output is compact unless `pretty`, which
+    re-indents every feature.
+    """
+    name = orjson.dumps(layer["name"])
+    if not pretty:
+        head, sep, tail = b'{"type":"FeatureCollection","name":' + name + b',"features":[', b",", b"]}"
+    else:
+        head = b'{\n  "type": "FeatureCollection",\n  "name": ' + name + b',\n  "features": [\n    '
+        sep, tail = b",\n    ", b"\n  ]\n}\n"
+
+    yield head
+    first = True
+    with closing(chunks):
+        for chunk in chunks:
+            lines = chunk[:-1]
+            if pretty:
+                features = (
+                    orjson.dumps(orjson.loads(line), option=orjson.OPT_INDENT_2)
+                    for line in lines.split(b"\n")
+                )
+                body = sep.join(f.replace(b"\n", b"\n    ") for f in features)
+            else:
+                body = lines.replace(b"\n", sep)
+            yield (b"" if first else sep) + body
+            first = False
+    yield tail
+
+
+def _accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    True if an Accept-Encoding header allows gzip (q > 0). An explicit gzip
+    entry wins over "*", so "*;q=0, gzip" still accepts it.
+    """
+    weights = {}
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        q = params.strip().lower()
+        try:
+            weights[name.strip().lower()] = float(q[2:]) if q.startswith("q=") else 1.0
+        except ValueError:
+            weights[name.strip().lower()] = 0.0
+    return weights.get("gzip", weights.get("*", 0.0)) > 0
+
+
+def _gzip_chunks(chunks):
+    """Gzip a stream of text or bytes chunks on the fly."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    with closing(chunks):
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+def _etag_json(request: Request, payload: dict, tagged: dict) -> Response:
+    """
+    JSON response carrying a weak ETag derived from `tagged` (the part of
+    the payload that identifies its state); a matching If-None-Match gets
+    an empty 304 instead.
+    """
+    digest = hashlib.blake2b(orjson.dumps(tagged), digest_size=8).hexdigest()
+    etag = f'W/"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match") or ""
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(orjson.dumps(payload), media_type="application/json", headers=headers)
 
 
 def _geometry_type_to_fiona(geom_type: str) -> str:
@@ -238,6 +1023,15 @@ def _geometry_type_to_fiona(geom_type: str) -> str:
     return mapping.get(geom_type, "Unknown")
 
 
+def _geometry_type_to_ogr(geom_type: str) -> str:
+    """Map DB geometry type strings to pyogrio geometry type names."""
+    if geom_type.endswith("Z"):
+        return f"{geom_type[:-1]} Z"
+    if geom_type == "Geometry":
+        return "Unknown"
+    return geom_type
+
+
 def _build_fiona_schema(layer: dict, sample_props: dict) -> dict:
     """Build a Fiona schema dict from layer metadata and sample properties."""
     properties = {}
@@ -257,19 +1051,115 @@ def _build_fiona_schema(layer: dict, sample_props: dict) -> dict:
     }
 
 
-def _serialize_props(props: dict) -> dict:
-    """Ensure all property values are JSON-serializable strings for Fiona."""
-    out = {}
-    for k, v in props.items():
-        if v is None:
-            out[k] = None
-        elif isinstance(v, (dict, list)):
-            out[k] = json.dumps(v, default=str)
-        elif isinstance(v, datetime):
-            out[k] = v.isoformat()
-        else:
-            out[k] = v
-    return out
+# layers.fields type -> Fiona schema type; anything else is written as str
+_FIELD_KINDS = {
+    "integer": "int",
+    "decimal": "float",
+    "float": "float",
+    "number": "float",
+    "boolean": "bool",
+}
+
+
+def _declared_properties(layer: dict) -> dict:
+    """
+    Schema properties declared by the layer's `fields` metadata, cached
+    per layer alongside the layer lookup.
+    """
+    key = str(layer["id"])
+    declared = _declared_schema_cache.get(key)
+    if declared is None:
+        declared = {
+            field["name"]: _FIELD_KINDS.get(field.get("type"), "str")
+            for field in layer.get("fields") or []
+            if field.get("name") and field.get("type") != "note"
+        }
+        _declared_schema_cache.set(key, declared)
+    return declared
+
+
+def _infer_schema_from_sample(layer: dict, sample: list, keys: list) -> dict:
+    """
+    Build a Fiona schema over `keys` (see _layer_property_keys). Fields
+    declared on the layer keep their declared type, so leading NULLs cannot
+    mistype them. Other keys are typed by their first non-null value in a
+    few leading rows, and written as str if those rows have none.
+    """
+    declared = _declared_properties(layer)
+    sample_props = dict.fromkeys(k for k in keys if k not in declared)
+    for row in sample:
+        for k, v in row["props"].items():
+            if k in sample_props and sample_props[k] is None:
+                sample_props[k] = v
+    inferred = _build_fiona_schema(layer, sample_props)["properties"]
+    return {
+        "geometry": _geometry_type_to_fiona(layer.get("geometry_type", "Geometry")),
+        "properties": {k: declared[k] if k in declared else inferred[k] for k in keys},
+    }
+
+
+def _to_int(value):
+    if value is None or value.__class__ is int:
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    if value is None or value.__class__ is float:
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_bool(value):
+    if value is None or value.__class__ is bool:
+        return value
+    if isinstance(value, str):
+        return {"true": True, "1": True, "yes": True,
+                "false": False, "0": False, "no": False}.get(value.strip().lower())
+    return bool(value)
+
+
+def _json_text(value) -> str:
+    return orjson.dumps(value, default=str).decode()
+
+
+# Exact type -> text rendering; other values go through str()
+_TEXT_CONVERTERS = {dict: _json_text, list: _json_text, datetime: datetime.isoformat}
+
+
+def _to_text(value):
+    """Render a value for a "str" column; JSON for dicts and lists. Fiona
+    writes a number or bool given for a str field as NULL, so those are
+    rendered too, as the pyogrio writer does."""
+    if value is None:
+        return None
+    return _TEXT_CONVERTERS.get(value.__class__, str)(value)
+
+
+# Fiona schema type -> value converter
+_CONVERTERS = {"str": _to_text, "int": _to_int, "float": _to_float, "bool": _to_bool}
+
+
+def _compile_serializer(schema: dict):
+    """
+    Return a function projecting a props dict onto the schema keys, with
+    each key's conversion chosen once from its schema type rather than
+    re-checked on every row. Values a numeric or bool column cannot hold
+    (e.g. free text in a declared integer field) are written as NULL.
+    """
+    actions = [(key, _CONVERTERS[kind]) for key, kind in schema["properties"].items()]
+
+    def serialize(props: dict) -> dict:
+        get = props.get
+        return {key: fn(get(key)) for key, fn in actions}
+
+    return serialize
 
 
 # ── Endpoints ───────────────────────────────────────
@@ -280,197 +1170,262 @@ async def health():
     return {"status": "ok", "service": "export", "version": "2.0.0"}
 
 
-@app.get("/export/{project_slug}/{layer_id}")
-async def export_layer(
-    project_slug: str,
-    layer_id: str,
-    format: ExportFormat = Query(ExportFormat.geojson, description="Output format"),
-    status: StatusFilter = Query(StatusFilter.all, description="Filter by feature status"),
-    corrected: bool = Query(True, description="Merge latest correction into output"),
-):
+async def _iterate_off_loop(chunks):
     """
-    Export a layer's features in the requested format.
-    Supports: GeoJSON, GeoPackage, Shapefile, CSV, KML.
+    Iterate a blocking generator for a StreamingResponse, in the threadpool
+    as Starlette would, but also close it there when the client goes away:
+    closing cancels the COPY, joins its thread and returns the connection.
     """
-    layer, rows = _fetch_layer_features(layer_id, project_slug, status, corrected)
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            yield chunk
+    finally:
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(chunks.close)
 
-    if not rows:
-        raise HTTPException(
-            status_code=404,
-            detail="No features found matching the criteria.",
-        )
 
-    safe_name = layer["name"].replace(" ", "_")[:50]
+def _download_stream(chunks, media_type: str, filename: str, gzip: bool):
+    """
+    Stream a text export as an attachment, gzipped when the client
+    accepts it (nothing upstream compresses). Chunks are 64 KiB or more,
+    so each one compresses as a worthwhile block.
+    """
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Vary": "Accept-Encoding",
+    }
+    if gzip:
+        chunks = _gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(_iterate_off_loop(chunks), media_type=media_type, headers=headers)
+
 
+def _export_layer_sync(
+    project_slug: str,
+    layer_id: str,
+    format: ExportFormat,
+    status: StatusFilter,
+    corrected: bool,
+    pretty: bool = False,
+    gzip: bool = False,
+):
     # ── GeoJSON ──────────────────────────────────
+    # Features are rendered by PostGIS and streamed through COPY.
     if format == ExportFormat.geojson:
-        fc = _rows_to_geojson(layer, rows)
-        content = orjson.dumps(fc, option=orjson.OPT_INDENT_2)
-        return Response(
-            content=content,
-            media_type="application/geo+json",
-            headers={
-                "Content-Disposition": f'attachment; filename="{safe_name}.geojson"'
-            },
+        layer, features = _copy_layer_features(
+            layer_id,
+            project_slug,
+            _copy_column(_GEOJSON_FEATURE_COLUMN, layer_id, status, corrected),
+            unescape=True,
+        )
+        safe_name = layer["name"].replace(" ", "_")[:50]
+        return _download_stream(
+            _geojson_chunks(layer, features, pretty),
+            "application/geo+json",
+            f"{safe_name}.geojson",
+            gzip,
         )
 
     # ── CSV ──────────────────────────────────────
+    # Written by PostgreSQL itself (COPY ... WITH (FORMAT csv)).
     if format == ExportFormat.csv:
-        fc = _rows_to_geojson(layer, rows)
-        buf = io.StringIO()
-        if fc["features"]:
-            first_props = fc["features"][0]["properties"]
-            fieldnames = ["_wkt"] + list(first_props.keys())
-            writer = csv.DictWriter(buf, fieldnames=fieldnames)
-            writer.writeheader()
-            for feat in fc["features"]:
-                geom = wkb.loads(
-                    bytes(
-                        next(
-                            r["geom_wkb"]
-                            for r in rows
-                            if str(r["id"]) == feat["id"]
-                        )
-                    )
-                )
-                row_dict = {"_wkt": geom.wkt}
-                row_dict.update(
-                    {k: json.dumps(v, default=str) if isinstance(v, (dict, list)) else v
-                     for k, v in feat["properties"].items()}
-                )
-                writer.writerow(row_dict)
-
-        return Response(
-            content=buf.getvalue(),
-            media_type="text/csv",
-            headers={
-                "Content-Disposition": f'attachment; filename="{safe_name}.csv"'
-            },
+        layer, chunks = _copy_layer_features(
+            layer_id, project_slug, _copy_csv(layer_id, status, corrected)
         )
+        safe_name = layer["name"].replace(" ", "_")[:50]
+        return _download_stream(chunks, "text/csv", f"{safe_name}.csv", gzip)
+
+    # Columns are found up front, on a short-lived connection, so the file
+    # formats carry the same ones as CSV, not only those in the sample
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        keys = _layer_property_keys(
+            cur, layer_id, _get_layer(cur, layer_id, project_slug), status, corrected
+        )
+
+    layer, rows = _fetch_layer_features(
+        layer_id,
+        project_slug,
+        _WKB_COLUMNS,
+        status,
+        corrected,
+        cursor_factory=psycopg2.extras.RealDictCursor,
+    )
+
+    safe_name = layer["name"].replace(" ", "_")[:50]
 
     # ── Fiona-based formats (GPKG, SHP, KML) ────
     driver_map = {
         ExportFormat.gpkg: ("GPKG", "application/geopackage+sqlite3", ".gpkg"),
-        ExportFormat.shp: ("ESRI Shapefile", "application/x-shapefile", ".shp.zip"),
+        ExportFormat.shp: ("ESRI Shapefile", "application/zip", ".shp.zip"),
         ExportFormat.kml: ("KML", "application/vnd.google-earth.kml+xml", ".kml"),
     }
 
     driver, media_type, ext = driver_map[format]
 
-    fc = _rows_to_geojson(layer, rows)
-
-    # Collect all property keys for schema
-    all_props: dict = {}
-    for feat in fc["features"]:
-        for k, v in feat["properties"].items():
-            if k not in all_props and v is not None:
-                all_props[k] = v
-    schema = _build_fiona_schema(layer, all_props)
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        if format == ExportFormat.shp:
-            # Shapefile: write then zip all component files
-            shp_path = os.path.join(tmpdir, f"{safe_name}.shp")
-            with fiona.open(shp_path, "w", driver=driver, schema=schema, crs="EPSG:4326") as dst:
-                for feat in fc["features"]:
-                    dst.write(
-                        {
-                            "geometry": feat["geometry"],
-                            "properties": _serialize_props(feat["properties"]),
-                        }
-                    )
-
-            # Create zip of all shapefile components
-            import zipfile
-
-            zip_buf = io.BytesIO()
-            with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_DEFLATED) as zf:
-                for fname in os.listdir(tmpdir):
-                    fpath = os.path.join(tmpdir, fname)
-                    zf.write(fpath, fname)
-            zip_buf.seek(0)
-
-            return Response(
-                content=zip_buf.getvalue(),
-                media_type="application/zip",
-                headers={
-                    "Content-Disposition": f'attachment; filename="{safe_name}.shp.zip"'
-                },
-            )
+    # The file is streamed from disk, so the directory outlives this
+    # function and is removed once the response has been sent.
+    tmpdir = tempfile.mkdtemp(prefix="export_")
+    try:
+        # Undeclared columns are typed from a leading sample; every record
+        # is projected onto the schema keys so Fiona accepts it.
+        sample = list(itertools.islice(rows, SCHEMA_SAMPLE_SIZE))
+        schema = _infer_schema_from_sample(layer, sample, keys)
+
+        # Shapefiles are appended to a plain .shp (GDAL rewrites a .shz on
+        # every append) and the component files are zipped once at the end
+        is_shp = format == ExportFormat.shp
+        out_path = os.path.join(tmpdir, f"{safe_name}{'.shp' if is_shp else ext}")
+        if EXPORT_ENGINE == "fiona" or driver not in APPEND_DRIVERS:
+            with fiona.open(out_path, "w", driver=driver, schema=schema, crs="EPSG:4326") as dst:
+                dst.writerecords(_fiona_records(itertools.chain(sample, rows), layer, schema))
         else:
+            _write_pyogrio(out_path, driver, layer, schema, itertools.chain(sample, rows))
+
+        if is_shp:
+            components = os.listdir(tmpdir)
             out_path = os.path.join(tmpdir, f"{safe_name}{ext}")
-            with fiona.open(out_path, "w", driver=driver, schema=schema, crs="EPSG:4326") as dst:
-                for feat in fc["features"]:
-                    dst.write(
-                        {
-                            "geometry": feat["geometry"],
-                            "properties": _serialize_props(feat["properties"]),
-                        }
-                    )
-
-            with open(out_path, "rb") as f:
-                content = f.read()
-
-            return Response(
-                content=content,
-                media_type=media_type,
-                headers={
-                    "Content-Disposition": f'attachment; filename="{safe_name}{ext}"'
-                },
-            )
+            with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED) as zf:
+                for fname in components:
+                    zf.write(os.path.join(tmpdir, fname), fname)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    finally:
+        # Hands the connection back here, in the worker thread, even if
+        # writing stopped before the rows ran out
+        rows.close()
+
+    return FileResponse(
+        out_path,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{safe_name}{ext}"'
+        },
+        background=BackgroundTask(shutil.rmtree, tmpdir, ignore_errors=True),
+    )
 
 
-@app.get("/export/{project_slug}/{layer_id}/meta")
-async def export_meta(
+@app.get("/export/{project_slug}/{layer_id}")
+async def export_layer(
+    request: Request,
     project_slug: str,
     layer_id: str,
-    status: StatusFilter = Query(StatusFilter.all),
+    format: ExportFormat = Query(ExportFormat.geojson, description="Output format"),
+    status: StatusFilter = Query(StatusFilter.all, description="Filter by feature status"),
+    corrected: bool = Query(True, description="Merge latest correction into output"),
+    pretty: bool = Query(False, description="Indent GeoJSON output"),
 ):
-    """Return metadata about what would be exported (feature count, etc.)."""
-    layer, rows = _fetch_layer_features(layer_id, project_slug, status, use_corrected=False)
+    """
+    Export a layer's features in the requested format.
+    Supports: GeoJSON, GeoPackage, Shapefile, CSV, KML.
+    """
+    return await run_in_threadpool(
+        _export_layer_sync,
+        project_slug,
+        layer_id,
+        format,
+        status,
+        corrected,
+        pretty,
+        _accepts_gzip(request.headers.get("accept-encoding")),
+    )
+
+
+def _export_meta_sync(project_slug: str, layer_id: str, status: StatusFilter):
+    feature_count = _count_layer_features(layer_id, project_slug, status)
     return ExportMeta(
         project_slug=project_slug,
         layer_id=layer_id,
         format=ExportFormat.geojson,
         status=status,
-        feature_count=len(rows),
+        feature_count=feature_count,
         exported_at=datetime.utcnow().isoformat(),
     )
 
 
-@app.get("/projects/{project_slug}/layers")
-async def list_layers(project_slug: str):
-    """List all layers in a project (for export UI)."""
-    conn = get_conn()
-    try:
+@app.get("/export/{project_slug}/{layer_id}/meta")
+async def export_meta(
+    request: Request,
+    project_slug: str,
+    layer_id: str,
+    status: StatusFilter = Query(StatusFilter.all),
+):
+    """Return metadata about what would be exported (feature count, etc.)."""
+    meta = await run_in_threadpool(_export_meta_sync, project_slug, layer_id, status)
+    payload = meta.model_dump(mode="json")
+    # exported_at changes on every call and does not count as a change
+    tagged = {k: v for k, v in payload.items() if k != "exported_at"}
+    return _etag_json(request, payload, tagged)
+
+
+def _list_layers_sync(project_slug: str):
+    cached = _layer_list_cache.get(project_slug)
+    if cached is not None:
+        return cached
+
+    with get_conn() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(
+        _execute_prepared(
+            cur,
+            "export_list_layers",
             """
-            SELECT l.id, l.name, l.geometry_type, l.is_reference,
+            SELECT l.id::text AS id, l.name, l.geometry_type, l.is_reference,
                    l.display_order, l.group_name,
-                   (SELECT count(*) FROM public.features WHERE layer_id = l.id) AS feature_count
+                   count(f.id) AS feature_count
             FROM public.layers l
             JOIN public.projects p ON p.id = l.project_id
-            WHERE p.slug = %s
+            LEFT JOIN public.features f ON f.layer_id = l.id
+            WHERE p.slug = $1
+            GROUP BY l.id
             ORDER BY l.display_order
             """,
             (project_slug,),
         )
-        layers = cur.fetchall()
-        # Convert uuid to str
-        for lyr in layers:
-            lyr["id"] = str(lyr["id"])
-        return {"layers": layers}
-    finally:
-        conn.close()
+        result = {"layers": cur.fetchall()}
 
+    _layer_list_cache.set(project_slug, result)
+    return result
 
-@app.post("/webhook/kobo")
-async def kobo_webhook(payload: dict):
+
+@app.get("/projects/{project_slug}/layers")
+async def list_layers(request: Request, project_slug: str):
+    """List all layers in a project (for export UI)."""
+    result = await run_in_threadpool(_list_layers_sync, project_slug)
+    return _etag_json(request, result, result)
+
+
+def _kobo_layer(cur, kobo_form_id: str):
     """
-    Receives KoboToolbox webhook submissions.
-    Expected to find '_id', '_geolocation', and fields mapped to layer properties.
+    Return (layer_id, fields) of the layer configured for a Kobo form, or
+    None. Hits are cached for LOOKUP_CACHE_TTL seconds.
     """
+    hit = _kobo_layer_cache.get(kobo_form_id)
+    if hit is not None:
+        return hit
+
+    # For v2, we assume form_config JSONB contains 'kobo_form_id'
+    _execute_prepared(
+        cur,
+        "kobo_layer",
+        """
+        SELECT id, fields
+        FROM public.layers
+        WHERE form_config->>'kobo_form_id' = $1
+        LIMIT 1
+        """,
+        (kobo_form_id,),
+    )
+    layer = cur.fetchone()
+    if not layer:
+        return None
+
+    hit = (str(layer["id"]), layer.get("fields") or [])
+    _kobo_layer_cache.set(kobo_form_id, hit)
+    return hit
+
+
+def _kobo_webhook_sync(payload: dict):
     # Quick validation
     kobo_form_id = payload.get("_xform_id_string")
     submission_id = payload.get("_id")
@@ -478,106 +1433,98 @@ async def kobo_webhook(payload: dict):
     if not kobo_form_id or not submission_id:
         raise HTTPException(status_code=400, detail="Missing _xform_id_string or _id")
 
-    conn = get_conn()
-    try:
+    with get_conn() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         # Find the layer configured for this Kobo form
-        # We query the layers table where form_config->>'kobo_form_id' matches or similar logic
-        # For v2, we assume form_config JSONB contains 'kobo_form_id'
-        cur.execute(
-            """
-            SELECT id, fields, project_id 
-            FROM public.layers 
-            WHERE form_config->>'kobo_form_id' = %s
-            LIMIT 1
-            """,
-            (str(kobo_form_id),)
-        )
-        layer = cur.fetchone()
-
+        layer = _kobo_layer(cur, str(kobo_form_id))
         if not layer:
-            # If we don't find it strictly by form_config, try finding any layer
-            # just to avoid dropping data if it's uniquely mapped
             raise HTTPException(status_code=404, detail=f"No layer configured for Kobo form {kobo_form_id}")
 
-        layer_id = str(layer["id"])
-        fields_schema = layer.get("fields", [])
+        layer_id, fields_schema = layer
 
         # Match submission data to layer fields
         props_patch = {}
         for field in fields_schema:
             field_name = field.get("name")
             kobo_name = field.get("kobo_question_name", field_name)
-            
+        
             if kobo_name in payload:
                 props_patch[field_name] = payload[kobo_name]
 
-        # Extract geometry from _geolocation [lat, lon]
-        geom_wkt = None
-        gps_point_wkt = None
+        # Extract geometry from _geolocation [lat, lon]; PostGIS builds
+        # the point (NULL coordinates give a NULL geometry)
+        lat = lon = None
         geolocation = payload.get("_geolocation")
-        
+    
         if geolocation and len(geolocation) >= 2 and geolocation[0] is not None and geolocation[1] is not None:
             lat = float(geolocation[0])
             lon = float(geolocation[1])
-            pt = Point(lon, lat)
-            geom_wkt = pt.wkt
-            gps_point_wkt = pt.wkt
 
         # Find if this submission updates an existing feature via a specific tracking field (e.g. 'feature_id')
         # Kobo forms usually pass the original feature id in a hidden field. Let's look for 'feature_id' or similar.
         feature_id = payload.get("feature_id") or payload.get("id_feature")
-        
+    
         if not feature_id:
             # Fallback: We can't link this to a specific feature cleanly without an ID.
             # Might store it as a new feature or orphan correction.
             raise HTTPException(status_code=400, detail="Submission missing feature_id linking field")
 
-        # Upsert the correction
+        # Insert the correction and flip a locked feature to 'corrected'
+        # in a single round trip
         query = """
-            INSERT INTO public.corrections (
-                feature_id, layer_id, props_patch, geom_corrected, gps_point, 
-                kobo_submission_id, kobo_form_id, status, created_at, updated_at
-            ) VALUES (
-                %s, %s, %s, 
-                ST_GeomFromText(%s, 4326), 
-                ST_GeomFromText(%s, 4326), 
-                %s, %s, 'submitted', now(), now()
+            WITH ins AS (
+                INSERT INTO public.corrections (
+                    feature_id, layer_id, props_patch, geom_corrected, gps_point, 
+                    kobo_submission_id, kobo_form_id, status, created_at, updated_at
+                ) VALUES (
+                    $1, $2, $3, 
+                    ST_SetSRID(ST_MakePoint($4::float8, $5::float8), 4326),
+                    ST_SetSRID(ST_MakePoint($4::float8, $5::float8), 4326),
+                    $6, $7, 'submitted', now(), now()
+                )
+                ON CONFLICT (kobo_submission_id) WHERE kobo_submission_id IS NOT NULL
+                DO UPDATE SET
+                    props_patch = EXCLUDED.props_patch,
+                    geom_corrected = EXCLUDED.geom_corrected,
+                    gps_point = EXCLUDED.gps_point,
+                    updated_at = now()
+                RETURNING feature_id
             )
-            ON CONFLICT (id) DO NOTHING
-            RETURNING id;
+            UPDATE public.features f
+            SET status = 'corrected', updated_at = now()
+            FROM ins
+            WHERE f.id = ins.feature_id AND f.status = 'locked'
         """
-        
-        # NOTE: UPSERT logic on conflict might require a UNIQUE constraint on Kobo submission ID.
-        # Since we use UUID primary keys by default, we just insert. 
-        # To make it truly idempotent based on Kobo ID, you'd add a unique constraint on (kobo_submission_id).
-        
-        cur.execute(
-            query,
-            (
-                feature_id,
-                layer_id,
-                orjson.dumps(props_patch).decode('utf-8'),
-                geom_wkt,
-                gps_point_wkt,
-                str(submission_id),
-                str(kobo_form_id)
+
+        # Kobo retries resend the same _id: the unique index on
+        # kobo_submission_id turns them into updates (kobo_submission_unique.sql)
+        try:
+            _execute_prepared(
+                cur,
+                "kobo_correction",
+                query,
+                (
+                    feature_id,
+                    layer_id,
+                    orjson.dumps(props_patch).decode('utf-8'),
+                    lon, lat,
+                    str(submission_id),
+                    str(kobo_form_id)
+                )
             )
-        )
-        
-        # Also auto-update feature status to 'corrected'
-        cur.execute(
-            "UPDATE public.features SET status = 'corrected', updated_at = now() WHERE id = %s AND status = 'locked'",
-            (feature_id,)
-        )
-        
-        conn.commit()
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
         return {"status": "success", "layer_id": layer_id, "feature_id": feature_id}
-        
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
+
+@app.post("/webhook/kobo")
+async def kobo_webhook(payload: dict):
+    """
+    Receives KoboToolbox webhook submissions.
+    Expected to find '_id', '_geolocation', and fields mapped to layer properties.
+    """
+    return await run_in_threadpool(_kobo_webhook_sync, payload)
@@ -0,0 +1,30 @@
+"""Checks for the export writers that need no database."""
+
+import struct
+
+import fiona
+
+import main
+
+
+def _point_wkb(x: float, y: float) -> bytes:
+    return struct.pack("<BIdd", 1, 1, x, y)
+
+
+def test_number_in_declared_text_field_survives_kml(tmp_path):
+    layer = {
+        "id": "layer-1",
+        "name": "Layer",
+        "geometry_type": "Point",
+        "fields": [{"name": "code", "type": "select_one"}],
+    }
+    rows = [{"geom_wkb": _point_wkb(1.0, 2.0), "props": {"code": 5}}]
+    schema = main._infer_schema_from_sample(layer, rows, ["code"])
+    assert schema["properties"] == {"code": "str"}
+
+    path = str(tmp_path / "layer.kml")
+    with fiona.open(path, "w", driver="KML", schema=schema, crs="EPSG:4326") as dst:
+        dst.writerecords(main._fiona_records(rows, layer, schema))
+
+    with open(path) as f:
+        assert '<SimpleData name="code">5</SimpleData>' in f.read()
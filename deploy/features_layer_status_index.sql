@@ -0,0 +1,9 @@
+-- Migration: composite index for per-layer, per-status feature scans
+-- Run with: docker exec -i deploy-db-1 psql -h 127.0.0.1 -U supabase_admin -d postgres < deploy/features_layer_status_index.sql
+--
+-- Lets the export service count a layer's features by status (export
+-- meta, layer list) with an index-only scan, and serves filtered exports.
+-- Built concurrently, so it must run outside a transaction block.
+
+create index concurrently if not exists idx_features_layer_status
+  on public.features(layer_id, status);
@@ -0,0 +1,29 @@
+-- Migration: notify the export service when feature counts change
+-- Run with: docker exec -i deploy-db-1 psql -h 127.0.0.1 -U supabase_admin -d postgres < deploy/features_notify.sql
+--
+-- The export service caches per-layer feature counts (layer list, export
+-- meta) and property keys (CSV and file exports), and LISTENs on
+-- features_changed to drop them when features are added, removed or
+-- change status or properties, or when corrections are made.
+
+begin;
+
+create or replace function public.notify_features_changed()
+returns trigger language plpgsql as $$
+begin
+  perform pg_notify('features_changed', '');
+  return null;
+end;
+$$;
+
+drop trigger if exists trg_features_notify on public.features;
+create trigger trg_features_notify
+after insert or delete or update of status, props on public.features
+for each statement execute function public.notify_features_changed();
+
+drop trigger if exists trg_corrections_notify on public.corrections;
+create trigger trg_corrections_notify
+after insert or delete or update of props_patch on public.corrections
+for each statement execute function public.notify_features_changed();
+
+commit;
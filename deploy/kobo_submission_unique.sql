@@ -0,0 +1,20 @@
+-- Migration: one correction per Kobo submission
+-- Run with: docker exec -i deploy-db-1 psql -h 127.0.0.1 -U supabase_admin -d postgres < deploy/kobo_submission_unique.sql
+--
+-- The export service upserts webhook deliveries on kobo_submission_id,
+-- so retried submissions update the existing correction instead of
+-- inserting a duplicate.
+
+begin;
+
+-- Keep only the newest correction of each already-duplicated submission
+delete from public.corrections c
+using public.corrections d
+where c.kobo_submission_id is not null
+  and c.kobo_submission_id = d.kobo_submission_id
+  and (c.created_at, c.id) < (d.created_at, d.id);
+
+create unique index if not exists idx_corrections_kobo_submission
+  on public.corrections(kobo_submission_id) where kobo_submission_id is not null;
+
+commit;
@@ -0,0 +1,27 @@
+-- Migration: notify the export service when layers change
+-- Run with: docker exec -i deploy-db-1 psql -h 127.0.0.1 -U supabase_admin -d postgres < deploy/layers_notify.sql
+--
+-- The export service caches layer lookups and LISTENs on layers_changed
+-- to drop them as soon as a layer (or a project slug) is modified.
+
+begin;
+
+create or replace function public.notify_layers_changed()
+returns trigger language plpgsql as $$
+begin
+  perform pg_notify('layers_changed', '');
+  return null;
+end;
+$$;
+
+drop trigger if exists trg_layers_notify on public.layers;
+create trigger trg_layers_notify
+after insert or update or delete on public.layers
+for each statement execute function public.notify_layers_changed();
+
+drop trigger if exists trg_projects_notify on public.projects;
+create trigger trg_projects_notify
+after update or delete on public.projects
+for each statement execute function public.notify_layers_changed();
+
+commit;